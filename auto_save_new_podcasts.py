@@ -9,7 +9,7 @@ Spotify Podcast Auto-Save + WhatsApp (Meta Cloud API)
 - Sends a WhatsApp template summary via Meta WhatsApp Cloud API
 
 Requires:
-  pip install spotipy python-dateutil requests
+  pip install spotipy python-dateutil requests orjson
 
 Environment variables required (Spotify):
   SPOTIPY_CLIENT_ID
@@ -25,19 +25,32 @@ Optional (WhatsApp):
   WA_LANG                  (default: en)
   WA_TPL_ADDED             (default: autosave_added)
   WA_TPL_NONE              (default: autosave_none)
+  WA_WAIT_SECONDS          (default: 5, max wait for the send before exiting)
 
 Optional (Script behavior):
   LOOKBACK_DAYS            (default: 7)
-  EPISODES_PER_SHOW        (default: 20)
+  EPISODES_PER_SHOW        (default: 50)
   SPOTIFY_MARKET           (default: from_token)
+  FETCH_WORKERS            (default: 10, concurrent show and page fetches)
 """
 
 import os
 import sys
-import json
+import time
+import atexit
+import threading
+import functools
+import orjson
 import requests
-from datetime import datetime, timedelta, timezone
-from dateutil import parser as dateparser
+import spotipy
+from spotipy.oauth2 import SpotifyOAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from typing import AbstractSet, Any, Dict, List, Optional, Set, Tuple
+
+from spotify_token_cache import MemoCacheFileHandler
 
 # ----- PATHS / CONFIG ---------------------------------------------------------
 BASE_DIR   = os.path.join(os.getcwd(), "spotify_autosave")
@@ -46,10 +59,13 @@ CACHE_PATH = os.path.join(BASE_DIR, "spotify_cache.json")
 STATE_FILE = os.path.join(BASE_DIR, "podcast_state.json")
 
 LOOKBACK_DAYS     = int(os.environ.get("LOOKBACK_DAYS", "7"))
-EPISODES_PER_SHOW = int(os.environ.get("EPISODES_PER_SHOW", "20"))
+EPISODES_PER_SHOW = int(os.environ.get("EPISODES_PER_SHOW", "50"))
 MARKET            = os.environ.get("SPOTIFY_MARKET", "from_token")
+FETCH_WORKERS     = int(os.environ.get("FETCH_WORKERS", "10"))
 
 SCOPES = ["user-library-read", "user-library-modify"]
+PAGE_LIMIT = 50  # Spotify's maximum page size for the paging endpoints used here
+SAVED_IDS_LIMIT = 10000  # most recent saved-episode IDs remembered in the state file
 
 # WhatsApp Cloud API config
 WA_ACCESS_TOKEN    = os.environ.get("WA_ACCESS_TOKEN", "").strip()
@@ -58,76 +74,161 @@ WA_TO              = os.environ.get("WA_TO", "").strip()
 WA_LANG            = os.environ.get("WA_LANG", "en").strip()
 WA_TPL_ADDED       = os.environ.get("WA_TPL_ADDED", "autosave_added").strip()
 WA_TPL_NONE        = os.environ.get("WA_TPL_NONE",  "autosave_none").strip()
+WA_WAIT_SECONDS    = float(os.environ.get("WA_WAIT_SECONDS", "5"))
 
 # Ensure base dir exists
 os.makedirs(BASE_DIR, exist_ok=True)
 
+# ----- HTTP SESSION ----------------------------------------------------------
+# One pooled session for Spotify and WhatsApp so connections (and TLS) are reused.
+# Throttled (429) and transient 5xx responses are retried with exponential backoff.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=6,
+        backoff_factor=1.0,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "POST", "PUT"]),
+        respect_retry_after_header=True,
+    ),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
 # ----- SIMPLE LOGGER ---------------------------------------------------------
+# Opened once per run; buffered writes are flushed when the interpreter exits.
+_LOG_FH = open(LOG_PATH, "a", encoding="utf-8-sig", buffering=8192)
+atexit.register(_LOG_FH.close)
+
 def log(message: str) -> None:
     """Append a line to autosave.log and print to console."""
-    line = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} | {message}"
+    line = f"{time.strftime('%Y-%m-%d %H:%M:%S')} | {message}"
     print(line)
-    with open(LOG_PATH, "a", encoding="utf-8-sig") as f:
-        f.write(line + "\n")
+    if not _LOG_FH.closed:
+        _LOG_FH.write(line + "\n")
 
 log("=" * 70)
 log("Run started")
 
 # ----- SPOTIFY ---------------------------------------------------------------
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-
 def get_spotify_client():
     required = ("SPOTIPY_CLIENT_ID", "SPOTIPY_CLIENT_SECRET", "SPOTIPY_REDIRECT_URI")
     missing = [v for v in required if not os.environ.get(v)]
     if missing:
         raise RuntimeError("Missing Spotify env vars: " + ", ".join(missing))
-    auth = SpotifyOAuth(scope=" ".join(SCOPES), cache_path=CACHE_PATH)
-    return spotipy.Spotify(auth_manager=auth)
-
-def parse_release_date(s):
+    auth = SpotifyOAuth(
+        scope=" ".join(SCOPES),
+        cache_handler=MemoCacheFileHandler(cache_path=CACHE_PATH),
+        requests_session=SESSION,
+    )
+    return spotipy.Spotify(auth_manager=auth, requests_session=SESSION)
+
+@functools.lru_cache(maxsize=4096)
+def parse_release_date(s: Optional[str]) -> Optional[date]:
     if not s:
         return None
     try:
-        return dateparser.parse(s).date()
+        # Fast path: Spotify release dates are usually plain YYYY-MM-DD
+        return date.fromisoformat(s)
+    except (TypeError, ValueError):
+        pass
+    from dateutil import parser as _dateparser
+    try:
+        return _dateparser.parse(s).date()
     except Exception:
         return None
 
+def filter_new_episodes(
+    eps: List[dict], baseline: date, already_saved: AbstractSet[str], seen: Set[str]
+) -> Tuple[List[str], date]:
+    """Return (IDs released after baseline and not saved/seen yet, newest release date)."""
+    new_ids: List[str] = []
+    newest: date = baseline
+    for ep in eps:
+        ep_id: str = ep["id"]
+        rel_date: Optional[date] = parse_release_date(ep.get("release_date", ""))
+        if not rel_date:
+            continue
+        if rel_date > baseline and ep_id not in seen and ep_id not in already_saved:
+            seen.add(ep_id)
+            new_ids.append(ep_id)
+            if rel_date > newest:
+                newest = rel_date
+    return new_ids, newest
+
+def get_all_pages(fetch_page, limit=PAGE_LIMIT):
+    """Fetch the first page, then the remaining pages concurrently using its 'total'."""
+    first = fetch_page(limit, 0)
+    items = list(first.get("items", []))
+    total = first.get("total") or 0
+    offsets = range(limit, total, limit)
+    if offsets:
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+            for page in pool.map(lambda off: fetch_page(limit, off), offsets):
+                items.extend(page.get("items", []))
+    return items
+
 def get_all_saved_shows(sp):
-    shows, offset, limit = [], 0, 50
-    while True:
-        page = sp.current_user_saved_shows(limit=limit, offset=offset, market=MARKET)
-        items = page.get("items", [])
-        shows.extend(items)
-        if len(items) < limit:
-            break
-        offset += limit
-    return shows
+    return get_all_pages(
+        lambda limit, offset: sp.current_user_saved_shows(limit=limit, offset=offset, market=MARKET)
+    )
 
-def get_recent_episodes_for_show(sp, show_id, max_items=20):
-    episodes, offset, limit, fetched = [], 0, min(50, max_items), 0
+def get_recent_episodes_for_show(sp, show_id, max_items=EPISODES_PER_SHOW, stop_before_date=None):
+    """Episodes come newest-first, so stop paging once one is on/before stop_before_date."""
+    episodes, offset, limit, fetched = [], 0, PAGE_LIMIT, 0
     while fetched < max_items:
         page = sp.show_episodes(show_id, market=MARKET, limit=limit, offset=offset)
         items = page.get("items", [])
         if not items:
             break
-        episodes.extend(items)
+        reached_baseline = False
+        for ep in items:
+            rel_date = parse_release_date(ep.get("release_date", ""))
+            if stop_before_date and rel_date and rel_date <= stop_before_date:
+                reached_baseline = True
+                break
+            episodes.append(ep)
         fetched += len(items)
-        if len(items) < limit:
+        if reached_baseline or len(items) < limit:
             break
         offset += limit
-    return episodes
-
-def get_saved_episode_ids(sp):
-    """Return a set of episode IDs already in 'Your Episodes'."""
-    saved_ids, offset, limit = set(), 0, 50
+    return episodes[:max_items]
+
+def get_episodes_for_shows(sp, show_baselines, max_items=EPISODES_PER_SHOW):
+    """Fetch recent episodes for many shows concurrently.
+
+    show_baselines maps show_id -> date to stop paging at; returns {show_id: episodes}.
+    """
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        results = pool.map(
+            lambda sid: get_recent_episodes_for_show(sp, sid, max_items, show_baselines[sid]),
+            show_baselines,
+        )
+        return dict(zip(show_baselines, results))
+
+def get_saved_episode_ids(sp, known_ids=None):
+    """Return episode IDs in 'Your Episodes', most recently saved first.
+
+    Without known_ids the whole library is fetched. With the IDs cached from the
+    previous run, paging stops at the first page containing an already-known ID.
+    """
+    if not known_ids:
+        items = get_all_pages(
+            lambda limit, offset: sp.current_user_saved_episodes(limit=limit, offset=offset)
+        )
+        return [ep["episode"]["id"] for ep in items]
+
+    saved_ids, offset, limit = [], 0, PAGE_LIMIT
     while True:
         page = sp.current_user_saved_episodes(limit=limit, offset=offset)
         items = page.get("items", [])
         if not items:
             break
-        saved_ids.update(ep["episode"]["id"] for ep in items)
-        if len(items) < limit:
+        page_ids = [ep["episode"]["id"] for ep in items]
+        saved_ids.extend(page_ids)
+        if len(items) < limit or any(ep_id in known_ids for ep_id in page_ids):
             break
         offset += limit
     return saved_ids
@@ -136,24 +237,27 @@ def iso_date(d):
     return d.strftime("%Y-%m-%d")
 
 def load_state():
+    state = {"last_run": None, "show_meta": {}}
     if os.path.exists(STATE_FILE):
         try:
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(STATE_FILE, "rb") as f:
+                state.update(orjson.loads(f.read()))
         except Exception as e:
             log(f"Could not read state file: {e}")
-    return {"last_run": None, "show_latest_release": {}}
+    # Older state files only kept the latest release date per show
+    legacy = state.pop("show_latest_release", None) or {}
+    for show_id, latest in legacy.items():
+        state["show_meta"].setdefault(show_id, {"latest": latest})
+    return state
 
 def save_state(state):
     try:
-        with open(STATE_FILE, "w", encoding="utf-8") as f:
-            json.dump(state, f, indent=2, sort_keys=True)
+        with open(STATE_FILE, "wb") as f:
+            f.write(orjson.dumps(state, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
     except Exception as e:
         log(f"Failed to write state file: {e}")
 
 # ----- WHATSAPP (Meta Cloud API) ---------------------------------------------
-from typing import Optional, List
-
 def send_whatsapp_template(template_name: str, body_params: Optional[List[dict]] = None):
     """Send a WhatsApp template message via Meta Cloud API."""
     if not (WA_ACCESS_TOKEN and WA_PHONE_NUMBER_ID and WA_TO):
@@ -165,7 +269,7 @@ def send_whatsapp_template(template_name: str, body_params: Optional[List[dict]]
         "Authorization": f"Bearer {WA_ACCESS_TOKEN}",
         "Content-Type": "application/json"
     }
-    payload = {
+    payload: Dict[str, Any] = {
         "messaging_product": "whatsapp",
         "to": WA_TO,
         "type": "template",
@@ -181,7 +285,7 @@ def send_whatsapp_template(template_name: str, body_params: Optional[List[dict]]
         }]
 
     try:
-        r = requests.post(url, headers=headers, data=json.dumps(payload), timeout=30)
+        r = SESSION.post(url, headers=headers, data=orjson.dumps(payload), timeout=30)
         if r.ok:
             log(f"WhatsApp template '{template_name}' sent. Response: {r.text}")
         else:
@@ -197,6 +301,23 @@ def format_show_list(names, max_names=3):
         return ", ".join(names[:max_names]) + ", and more"
     return ", ".join(names)
 
+def send_summary(added, new_shows):
+    """Send the end-of-run WhatsApp summary (added count + show names); never raises."""
+    try:
+        if added > 0:
+            show_list = format_show_list(new_shows)
+            send_whatsapp_template(
+                WA_TPL_ADDED,
+                body_params=[
+                    {"type": "text", "text": str(added)},
+                    {"type": "text", "text": show_list}
+                ]
+            )
+        else:
+            send_whatsapp_template(WA_TPL_NONE)
+    except Exception as e:
+        log(f"WhatsApp send failed: {e}")
+
 # ----- MAIN ------------------------------------------------------------------
 def main():
     sp = get_spotify_client()
@@ -205,7 +326,7 @@ def main():
     now_utc = datetime.now(timezone.utc)
     last_run_str = state.get("last_run")
     if last_run_str:
-        baseline_date = dateparser.parse(last_run_str).date() - timedelta(days=1)
+        baseline_date = datetime.fromisoformat(last_run_str).date() - timedelta(days=1)
         log(f"Incremental run: baseline={baseline_date}")
     else:
         baseline_date = (now_utc - timedelta(days=LOOKBACK_DAYS)).date()
@@ -214,31 +335,45 @@ def main():
     saved_shows = get_all_saved_shows(sp)
     log(f"Found {len(saved_shows)} followed shows.")
 
-    already_saved = get_saved_episode_ids(sp)
+    known_ids = state.get("saved_episode_ids", [])
+    recent_ids = get_saved_episode_ids(sp, set(known_ids))
+    already_saved = frozenset(recent_ids).union(known_ids)
+    show_meta = state.setdefault("show_meta", {})
     episodes_to_save = []
+    seen = set()
     new_shows = []
 
+    # Shows whose episode count hasn't changed since the last run have nothing new
+    per_show_baselines = {}
+    for show_item in saved_shows:
+        show = show_item["show"]
+        meta = show_meta.get(show["id"], {})
+        total = show.get("total_episodes")
+        if total is not None and total == meta.get("total_episodes"):
+            continue
+        per_show_str = meta.get("latest")
+        per_show_baselines[show["id"]] = parse_release_date(per_show_str) if per_show_str else baseline_date
+
+    episodes_by_show = get_episodes_for_shows(sp, per_show_baselines, max_items=EPISODES_PER_SHOW)
+
     for show_item in saved_shows:
         show = show_item["show"]
         show_id = show["id"]
         show_name = show.get("name", show_id)
 
-        per_show_str = state["show_latest_release"].get(show_id)
-        per_show_baseline = parse_release_date(per_show_str) if per_show_str else baseline_date
+        if show_id not in per_show_baselines:
+            log(f"- {show_name}: unchanged since last run, skipped")
+            continue
 
-        eps = get_recent_episodes_for_show(sp, show_id, max_items=EPISODES_PER_SHOW)
-        new_count = 0
-        newest_seen_for_show = per_show_baseline
+        meta = show_meta.setdefault(show_id, {})
+        per_show_str = meta.get("latest")
+        per_show_baseline = per_show_baselines[show_id]
 
-        for ep in eps:
-            rel_date = parse_release_date(ep.get("release_date", ""))
-            if not rel_date:
-                continue
-            if rel_date > per_show_baseline and ep["id"] not in already_saved:
-                episodes_to_save.append(ep["id"])
-                new_count += 1
-                if not newest_seen_for_show or rel_date > newest_seen_for_show:
-                    newest_seen_for_show = rel_date
+        new_ids, newest_seen_for_show = filter_new_episodes(
+            episodes_by_show[show_id], per_show_baseline, already_saved, seen
+        )
+        episodes_to_save.extend(new_ids)
+        new_count = len(new_ids)
 
         if new_count > 0:
             new_shows.append(show_name)
@@ -246,43 +381,41 @@ def main():
         log(f"- {show_name}: +{new_count} new since {per_show_baseline}")
 
         if newest_seen_for_show and (not per_show_str or newest_seen_for_show > per_show_baseline):
-            state["show_latest_release"][show_id] = iso_date(newest_seen_for_show)
-
-    episodes_to_save = list(dict.fromkeys(episodes_to_save))
+            meta["latest"] = iso_date(newest_seen_for_show)
+        total = show.get("total_episodes")
+        if total is not None:
+            meta["total_episodes"] = total
 
     added = 0
     if episodes_to_save:
         CHUNK = 50
-        for i in range(0, len(episodes_to_save), CHUNK):
-            chunk = episodes_to_save[i:i+CHUNK]
-            sp.current_user_saved_episodes_add(chunk)
-            added += len(chunk)
+        chunks = [episodes_to_save[i:i+CHUNK] for i in range(0, len(episodes_to_save), CHUNK)]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(sp.current_user_saved_episodes_add, chunks))
+        added = len(episodes_to_save)
         log(f"Saved {added} new episode(s) to 'Your Episodes'.")
     else:
         log("No new episodes to save.")
 
+    state["saved_episode_ids"] = list(dict.fromkeys(episodes_to_save + recent_ids + known_ids))[:SAVED_IDS_LIMIT]
     state["last_run"] = now_utc.isoformat()
     save_state(state)
     log("Run finished")
 
-    try:
-        if added > 0:
-            show_list = format_show_list(new_shows)
-            send_whatsapp_template(
-                WA_TPL_ADDED,
-                body_params=[
-                    {"type": "text", "text": str(added)},
-                    {"type": "text", "text": show_list}
-                ]
-            )
-        else:
-            send_whatsapp_template(WA_TPL_NONE)
-    except Exception as e:
-        log(f"WhatsApp send failed: {e}")
+    # Don't hold up exit on Meta's response; the run's real work is already done
+    notifier = threading.Thread(target=send_summary, args=(added, new_shows), daemon=True)
+    notifier.start()
+    notifier.join(timeout=WA_WAIT_SECONDS)
+    if notifier.is_alive():
+        log(f"WhatsApp send still pending after {WA_WAIT_SECONDS:g}s; not waiting for it.")
 
-if __name__ == "__main__":
+def run():
+    """Entry point: run main() and exit non-zero on any fatal error."""
     try:
         main()
     except Exception as e:
         log(f"Fatal error: {e}")
         sys.exit(1)
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,30 @@
+"""
+Spotify token cache used by auto_save_new_podcasts.py.
+
+Kept in its own module so it stays plain Python when the main script is
+compiled with mypyc: compiled subclasses of spotipy's untyped classes
+cannot be constructed reliably.
+"""
+
+from spotipy.cache_handler import CacheFileHandler, CacheHandler
+
+
+class MemoCacheFileHandler(CacheHandler):
+    """Token cache that reads the cache file once per run and keeps the token in memory.
+
+    SpotifyOAuth asks its cache handler for the token before every API call; refreshed
+    tokens are still written through to the file.
+    """
+
+    def __init__(self, cache_path):
+        self._file = CacheFileHandler(cache_path=cache_path)
+        self._token = None
+
+    def get_cached_token(self):
+        if self._token is None:
+            self._token = self._file.get_cached_token()
+        return self._token
+
+    def save_token_to_cache(self, token_info):
+        self._token = token_info
+        self._file.save_token_to_cache(token_info)